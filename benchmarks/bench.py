@@ -0,0 +1,283 @@
+# Copyright 2023 Yevheniya Nosyk
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest.mock
+import tracemalloc
+import contextlib
+import functools
+import itertools
+import argparse
+import tempfile
+import time
+import json
+import sys
+import os
+import gc
+
+# The benchmarked modules live in src/
+sys.path.insert(0, os.path.join(os.path.split(os.path.split(os.path.abspath(__file__))[0])[0], "src"))
+
+import build_models
+import testcases
+import dns.message
+import dns.query
+import dns.flags
+import scan
+
+GRANULARITIES = ["vendor", "major", "minor", "build"]
+
+# The number of IP addresses classified at once, the default chunk size of the scanner
+CHUNK_SIZE = 100
+
+
+def fake_udp(q, where, timeout=None, **kwargs):
+    """Answer a query locally instead of sending it over the network"""
+
+    response = dns.message.make_response(q)
+    response.flags |= dns.flags.RA
+    return response
+
+
+@functools.lru_cache(maxsize=1)
+def load_signatures(granularity):
+    """Read the shipped signature file once, it is shared by the benchmarks of its granularity"""
+
+    return build_models.read_input_file(filename=f"{scan.get_work_dir()}/data/signatures/signatures_{granularity}.json.bz2", granularity=granularity)
+
+
+@functools.lru_cache(maxsize=1)
+def load_model(granularity):
+    """Build the decision tree and its vocabulary once per granularity"""
+
+    data_merged, weights = build_models.merge_labels(data_raw=load_signatures(granularity=granularity))
+    labels, features, vocabulary = build_models.data_to_matrix(data_merged=data_merged)
+    tree = build_models.create_model(labels=labels, features=features, vocabulary=vocabulary, weights=weights)
+
+    return tree, vocabulary
+
+
+def get_query(ip):
+    """Return the options of the first testcase, as scan.execute_queries builds them"""
+
+    query_combo = dict(zip(testcases.query_options.keys(), (i[0] for i in testcases.query_options.values())))
+    query_name = "_".join([query_combo[i] for i in query_combo if query_combo[i]]).replace(".dnssoftver.com", "")
+
+    return {"query_name": query_name, "ip": ip, "query_options": query_combo}
+
+
+def get_scan_results(granularity):
+    """Turn the shipped signatures into the per-IP results of one scanner chunk"""
+
+    results = dict()
+    for i, entry in enumerate(itertools.islice(itertools.cycle(load_signatures(granularity=granularity)), CHUNK_SIZE)):
+        for software in entry:
+            results[f"192.0.2.{i}"] = {testcase: dict(signature) for testcase, signature in entry[software].items()}
+
+    return results
+
+
+@contextlib.contextmanager
+def setup_generate_dns_query():
+    """Build and send one query, the response comes from fake_udp"""
+
+    query = get_query(ip="192.0.2.1")
+    yield lambda: testcases.generate_dns_query(q_options=query)
+
+
+@contextlib.contextmanager
+def setup_parse_dns_query():
+    """Parse one canned response"""
+
+    response = fake_udp(q=dns.message.make_query("www.dnssoftver.com", "A"), where="192.0.2.1")
+    yield lambda: testcases.parse_dns_query(response=response)
+
+
+@contextlib.contextmanager
+def setup_execute_queries():
+    """Enumerate all the query combinations for the build testcases"""
+
+    # Only the enumeration of the combinations is timed, the queries themselves are not built
+    testcase_names = scan.get_testcases(filename=f"{scan.get_work_dir()}/data/queries/queries_build.txt")
+    stub = lambda q_options: {"ip": q_options["ip"], "query_name": q_options["query_name"], "signature": {}}
+
+    # The stub is patched in once, around all the timed operations
+    with unittest.mock.patch.object(testcases, "generate_dns_query", stub):
+        yield lambda: scan.execute_queries(ip_to_fingerprint="192.0.2.1", queries_important=testcase_names)
+
+
+@contextlib.contextmanager
+def setup_predict(granularity):
+    """Encode one chunk of scan results and classify it"""
+
+    tree, vocabulary = load_model(granularity=granularity)
+    results = get_scan_results(granularity=granularity)
+
+    def operation():
+        _, features = scan.get_model_data(data_input=results, vocabulary=vocabulary)
+        tree.predict(features)
+    yield operation
+
+
+@contextlib.contextmanager
+def setup_read_input_file(granularity):
+    """Read and decompress one shipped signature file"""
+
+    # This is the first benchmark of its granularity, the data of the previous one is not needed anymore
+    load_signatures.cache_clear()
+    load_model.cache_clear()
+    gc.collect()
+    filename = f"{scan.get_work_dir()}/data/signatures/signatures_{granularity}.json.bz2"
+    yield lambda: build_models.read_input_file(filename=filename, granularity=granularity)
+
+
+@contextlib.contextmanager
+def setup_merge_labels(granularity):
+    """Merge the labels of one shipped signature file"""
+
+    data = load_signatures(granularity=granularity)
+    yield lambda: build_models.merge_labels(data_raw=data)
+
+
+@contextlib.contextmanager
+def setup_data_to_matrix(granularity):
+    """One-hot encode one shipped signature file"""
+
+    data_merged, _ = build_models.merge_labels(data_raw=load_signatures(granularity=granularity))
+    yield lambda: build_models.data_to_matrix(data_merged=data_merged)
+
+
+@contextlib.contextmanager
+def setup_append_result(output_dir):
+    """Append one chunk of results to a temporary file"""
+
+    filename = os.path.join(output_dir, "append_result.json")
+    data = [(f"192.0.2.{i}", "bind9|unbound") for i in range(CHUNK_SIZE)]
+
+    def operation():
+        scan.append_result(filename=filename, data=data)
+    yield operation
+
+
+def get_benchmarks(output_dir):
+    """Return the benchmark names and their setup context managers, in the order they are run"""
+
+    benchmarks = {
+        "testcases.generate_dns_query": setup_generate_dns_query,
+        "testcases.parse_dns_query": setup_parse_dns_query,
+        "scan.execute_queries": setup_execute_queries,
+    }
+    # The benchmarks are grouped by granularity, so that only one signature file is loaded in memory at a time
+    for granularity in GRANULARITIES:
+        benchmarks[f"build_models.read_input_file[{granularity}]"] = functools.partial(setup_read_input_file, granularity=granularity)
+        benchmarks[f"build_models.merge_labels[{granularity}]"] = functools.partial(setup_merge_labels, granularity=granularity)
+        benchmarks[f"build_models.data_to_matrix[{granularity}]"] = functools.partial(setup_data_to_matrix, granularity=granularity)
+        benchmarks[f"scan.get_model_data+predict[{granularity}]"] = functools.partial(setup_predict, granularity=granularity)
+    benchmarks[f"scan.append_result[{CHUNK_SIZE}]"] = functools.partial(setup_append_result, output_dir=output_dir)
+
+    return benchmarks
+
+
+def measure(operation, min_time, rounds, memory):
+    """Return the best number of operations per second over the rounds and the peak memory of one operation"""
+
+    best = 0
+    for _ in range(rounds):
+        ops = 0
+        start = time.perf_counter()
+        while True:
+            operation()
+            ops += 1
+            elapsed = time.perf_counter() - start
+            if elapsed >= min_time:
+                break
+        best = max(best, ops / elapsed)
+        # Operations much slower than the minimal time are only timed once
+        if ops == 1 and elapsed > 10 * min_time:
+            break
+
+    peak_kib = None
+    if memory:
+        tracemalloc.start()
+        operation()
+        peak_kib = tracemalloc.get_traced_memory()[1] / 1024
+        tracemalloc.stop()
+
+    return best, peak_kib
+
+
+def compare(name, result, baseline, threshold):
+    """Return the list of regressions of one benchmark against its baseline"""
+
+    regressions = list()
+    if name not in baseline:
+        return regressions
+    if result["ops_per_sec"] < baseline[name]["ops_per_sec"] * (1 - threshold):
+        regressions.append(f"{name}: {result['ops_per_sec']:.2f} ops/s, baseline {baseline[name]['ops_per_sec']:.2f} ops/s")
+    # Ignore the memory changes of a few KiB, they are mostly noise
+    if result["peak_kib"] is not None and baseline[name].get("peak_kib") is not None:
+        if result["peak_kib"] > baseline[name]["peak_kib"] * (1 + threshold) and result["peak_kib"] - baseline[name]["peak_kib"] > 16:
+            regressions.append(f"{name}: {result['peak_kib']:.1f} KiB/op, baseline {baseline[name]['peak_kib']:.1f} KiB/op")
+
+    return regressions
+
+
+if __name__ == '__main__':
+
+    # Parse command-line arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-f', '--filter', required=False, type=str, help="Only run the benchmarks whose name contains this string")
+    parser.add_argument('-b', '--baseline_file', required=False, default=f"{scan.get_work_dir()}/benchmarks/baseline.json", type=str, help="The file with the recorded baselines")
+    parser.add_argument('-s', '--save', action="store_true", help="Record the results as the new baselines")
+    parser.add_argument('-t', '--threshold', required=False, default=0.2, type=float, help="The relative slowdown or memory increase reported as a regression, defaults to 0.2")
+    parser.add_argument('--min_time', required=False, default=0.5, type=float, help="The minimal number of seconds per round, defaults to 0.5")
+    parser.add_argument('--rounds', required=False, default=3, type=int, help="The number of rounds, the best one is kept, defaults to 3")
+    parser.add_argument('--no_memory', action="store_true", help="Do not measure the peak memory per operation")
+    args = parser.parse_args()
+
+    baseline = dict()
+    if os.path.exists(args.baseline_file):
+        with open(args.baseline_file, "r") as f:
+            baseline = json.load(f)
+
+    results = dict()
+    regressions = list()
+    print(f"{'benchmark':<45} {'ops/s':>12} {'KiB/op':>10} {'baseline':>10}")
+    # Everything runs offline, the DNS queries are answered locally
+    with tempfile.TemporaryDirectory() as output_dir, unittest.mock.patch.object(dns.query, "udp", fake_udp):
+        for name, setup in get_benchmarks(output_dir=output_dir).items():
+            if args.filter and args.filter not in name:
+                continue
+            with setup() as operation:
+                ops_per_sec, peak_kib = measure(operation=operation, min_time=args.min_time, rounds=args.rounds, memory=not args.no_memory)
+            # Release the results of the operations before the next benchmark
+            gc.collect()
+            results[name] = {"ops_per_sec": ops_per_sec, "peak_kib": peak_kib}
+            regressions += compare(name=name, result=results[name], baseline=baseline, threshold=args.threshold)
+            # Show the change relative to the baseline
+            change = f"{ops_per_sec / baseline[name]['ops_per_sec'] - 1:+.0%}" if name in baseline else "-"
+            memory = f"{peak_kib:.1f}" if peak_kib is not None else "-"
+            print(f"{name:<45} {ops_per_sec:>12.2f} {memory:>10} {change:>10}", flush=True)
+
+    if args.save:
+        # Keep the baselines of the benchmarks that were not run this time
+        baseline.update(results)
+        with open(args.baseline_file, "w") as f:
+            json.dump(baseline, f, indent=4, sort_keys=True)
+            f.write("\n")
+
+    if regressions:
+        print("Regressions:")
+        for regression in regressions:
+            print(f"  {regression}")
+        sys.exit(1)
@@ -12,14 +12,16 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import sklearn.model_selection
 import sklearn.tree
 import sklearn.metrics
+import scipy.sparse
 import collections
 import warnings
 import argparse
 import sklearn
 import pickle
+import numpy
+import math
 import json
 import bz2
 import os
@@ -77,7 +79,7 @@ def read_input_file(filename, granularity):
 
 
 def merge_labels(data_raw):
-    """Merge labels with identical signatures"""
+    """Merge labels with identical signatures and count how many times each signature was seen"""
 
     # Create a dictionnary with signatures as keys and the list of software as values
     signature_labels = collections.defaultdict(list)
@@ -88,68 +90,108 @@ def merge_labels(data_raw):
 
     # Invert the dictionnary to the software:signature form
     # This time, the software may be a concatenation of several labels
+    # Each signature is kept once, weighted by the number of its occurrences
     data = list()
+    weights = list()
     for signature in signature_labels:
         labels_merged = "|".join(tuple(sorted(set(signature_labels[signature]))))
         signature_dictionnary = {i[0]:i[1] for i in signature}
-        for _ in range(len(signature_labels[signature])):
-            data.append({labels_merged:signature_dictionnary})
-
-    return data
-
-
-def data_to_df(data_merged):
-    """Load the dataset to a Pandas dataframe"""
-
-    # Get all the column names from one of the entries
-    column_names_features = [j for i in data_merged[0].values() for j in i]
-    column_names_all = ["label"] + column_names_features
-
-    input_data_flat = list()
-    for entry in data_merged:
-        for software in entry:
-            entry_flat = list()
-            for column in column_names_all:
-                if column == "label":
-                    entry_flat.append(software)
-                else:
-                    entry_flat.append(entry[software][column])
-            input_data_flat.append(entry_flat)
-
-    df = pandas.DataFrame(input_data_flat, columns=column_names_all)
-    # Do the one hot encoding
-    df_one_hot = pandas.get_dummies(data=df, columns=column_names_features)
-
-    return df_one_hot
-
-
-def create_model(data, testcase_file=None, print_stats = False):
+        data.append({labels_merged:signature_dictionnary})
+        weights.append(len(signature_labels[signature]))
+
+    return data, weights
+
+
+def data_to_matrix(data_merged, vocabulary=None):
+    """One-hot encode the dataset as a sparse matrix with one column per (testcase, signature) pair"""
+
+    labels = [software for entry in data_merged for software in entry]
+    rows = [entry[software] for entry in data_merged for software in entry]
+
+    # At the training stage, build the vocabulary from the data
+    # It is sorted, so that it does not depend on the order of the entries
+    if vocabulary is None:
+        vocabulary = dict()
+        testcase_names = sorted(j for i in data_merged[0].values() for j in i)
+        codes = numpy.empty((len(rows), len(testcase_names)), dtype=numpy.int64)
+        for column, testcase in enumerate(testcase_names):
+            # Map each distinct signature of this testcase to an integer code
+            signature_codes = dict()
+            codes[:, column] = [signature_codes.setdefault(row[testcase], len(signature_codes)) for row in rows]
+            # Then replace the codes by the matrix columns, in the sorted order of signatures
+            code_to_column = numpy.empty(len(signature_codes), dtype=numpy.int64)
+            for signature in sorted(signature_codes, key=str):
+                code_to_column[signature_codes[signature]] = len(vocabulary)
+                vocabulary[(testcase, signature)] = len(vocabulary)
+            codes[:, column] = code_to_column[codes[:, column]]
+        # Every row has exactly one non-zero value per testcase, already sorted by column
+        indptr = numpy.arange(0, codes.size + 1, len(testcase_names))
+        matrix = scipy.sparse.csr_matrix((numpy.ones(codes.size, dtype=numpy.float32), codes.ravel(), indptr), shape=(len(rows), len(vocabulary)))
+    # Otherwise, reuse the training columns and leave out the signatures never seen before
+    else:
+        row_indices = list()
+        column_indices = list()
+        for row_index, row in enumerate(rows):
+            for testcase in row:
+                column = vocabulary.get((testcase, row[testcase]))
+                if column is not None:
+                    row_indices.append(row_index)
+                    column_indices.append(column)
+        matrix = scipy.sparse.csr_matrix((numpy.ones(len(column_indices), dtype=numpy.float32), (row_indices, column_indices)), shape=(len(rows), len(vocabulary)))
+
+    return labels, matrix, vocabulary
+
+
+def feature_names(vocabulary):
+    """Return the names of the one-hot matrix columns"""
+
+    return [f"{testcase}_{signature}" for testcase, signature in vocabulary]
+
+
+def train_test_split_weighted(X, y, weights, test_size, random_state):
+    """Split the weighted unique rows as if each row was repeated weight times"""
+
+    # Draw the test occurrences without replacement among all the occurrences of all the rows,
+    # so that a row can end up in both sets, each with a part of its weight
+    weights = numpy.asarray(weights)
+    rng = numpy.random.default_rng(random_state)
+    weights_test = rng.multivariate_hypergeometric(weights, math.ceil(test_size * weights.sum()))
+    weights_train = weights - weights_test
+
+    y = numpy.asarray(y)
+    train = weights_train > 0
+    test = weights_test > 0
+
+    return X[train], X[test], y[train], y[test], weights_train[train], weights_test[test]
+
+
+def create_model(labels, features, vocabulary, weights, testcase_file=None, print_stats = False):
     """Create a Decision tree"""
 
-    # Split the dataset into features and target variables
-    X = data.loc[:, data.columns != 'label']
-    y = data.label
+    # The features are a sparse one-hot matrix and the target variables are the labels
+    X = features
+    y = labels
     # Split dataset into training set and test set
-    X_train, X_test, y_train, y_test = sklearn.model_selection.train_test_split(X, y, test_size=0.3, random_state=1) 
+    X_train, X_test, y_train, y_test, weights_train, weights_test = train_test_split_weighted(X, y, weights, test_size=0.3, random_state=1)
 
     # Create Decision Tree classifer object
     clf = sklearn.tree.DecisionTreeClassifier(random_state=1)
-    # Train Decision Tree Classifer
-    clf = clf.fit(X_train,y_train)
+    # Train Decision Tree Classifer, a weight is the same as repeating the signature that many times
+    clf = clf.fit(X_train,y_train,sample_weight=weights_train)
     # Predict the response for test dataset
     y_pred = clf.predict(X_test)
 
     # Describe the model performance
-    model_accuracy = sklearn.metrics.accuracy_score(y_test, y_pred)
+    model_accuracy = sklearn.metrics.accuracy_score(y_test, y_pred, sample_weight=weights_test)
 
     # Analyze the feature importance, i.e. which ones were used to build the tree, and which ones not
-    feature_importances = pandas.DataFrame(data=clf.feature_importances_,columns=["importance"],index=X_train.columns)
+    feature_importances = pandas.DataFrame(data=clf.feature_importances_,columns=["importance"],index=feature_names(vocabulary=vocabulary))
     # Now we aggregate by the testcase names
     testcases_all = set(i.split("_((")[0] for i in feature_importances.index.to_list())
     testcases_important = set(i.split("_((")[0] for i in feature_importances[feature_importances['importance'] != 0].index.to_list())
     testcases_not_important_unique = testcases_all - testcases_important
     # Also check how many unique versions we got out of all:
-    labels_all = set(data["label"].to_list())
+    labels_all = set(labels)
     labels_individual = [i for i in labels_all if "|" not in i]
     versions_all = set(j for i in labels_all for j in i.split("|"))
 
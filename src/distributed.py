@@ -0,0 +1,322 @@
+# Copyright 2023 Yevheniya Nosyk
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# The coordinator hands out blocks of IP addresses to the workers over TCP.
+# Each message is one JSON object per line, and each connection carries one request and one response:
+#   {"type": "hello", "worker": <name>} -> {"type": "config", "granularity": <granularity>}
+#   {"type": "get", "worker": <name>} -> {"type": "block", "block_id": <id>, "granularity": <granularity>, "ips": [...]}
+#                                      | {"type": "wait"} | {"type": "done"}
+#   {"type": "renew", "worker": <name>, "block_id": <id>} -> {"type": "ok"} | {"type": "done"}
+#   {"type": "results", "worker": <name>, "block_id": <id>, "results": [[<ip>, <label>], ...]} -> {"type": "ok"} | {"type": "done"}
+# A block is leased to a worker for a limited time, which the worker renews after each chunk.
+# Once the lease of a silent worker expires, the block is given to another worker.
+# When there are no new blocks left, idle workers also get a copy of the oldest unfinished block,
+# so that a slow worker does not hold back the end of the scan. The first results received for a block are kept,
+# and "done" tells the other workers of this block to drop it.
+
+import socketserver
+import result_cache
+import collections
+import ip_ranges
+import threading
+import itertools
+import argparse
+import logging
+import socket
+import scan
+import json
+import time
+import os
+
+
+class Coordinator:
+    """Keep track of the blocks handed out to the workers and of their leases"""
+
+    def __init__(self, addresses, granularity, output_file, block_size, lease_time):
+        self.addresses = addresses
+        self.granularity = granularity
+        self.output_file = output_file
+        self.block_size = block_size
+        self.lease_time = lease_time
+        # The blocks handed out and not finished yet, by block ID
+        self.leases = collections.OrderedDict()
+        self.next_block_id = 0
+        self.exhausted = False
+        self.lock = threading.Lock()
+        self.finished = threading.Event()
+
+    def get_block(self, worker):
+        """Return the next block for the worker, None if there is nothing to do now"""
+
+        with self.lock:
+            now = time.monotonic()
+
+            # First, take back the blocks of the workers that are too slow or dead
+            for block_id, lease in self.leases.items():
+                if lease["deadline"] <= now:
+                    logging.warning(f"Block {block_id} of worker {lease['workers'][-1]} expired, reassigning to {worker}")
+                    lease["deadline"] = now + self.lease_time
+                    lease["workers"].append(worker)
+                    return block_id, lease["ips"]
+
+            # Then, cut a new block from the input addresses
+            if not self.exhausted:
+                ips = list(itertools.islice(self.addresses, self.block_size))
+                if ips:
+                    block_id = self.next_block_id
+                    self.next_block_id += 1
+                    self.leases[block_id] = {"ips": ips, "deadline": now + self.lease_time, "workers": [worker]}
+                    return block_id, ips
+                self.exhausted = True
+
+            # Finally, steal the oldest unfinished block that nobody else is working on in parallel
+            for block_id, lease in self.leases.items():
+                if len(lease["workers"]) == 1 and lease["workers"][0] != worker:
+                    lease["workers"].append(worker)
+                    return block_id, lease["ips"]
+
+            if not self.leases:
+                self.finished.set()
+            return None
+
+    def renew_block(self, block_id):
+        """Extend the lease of a block, return False if the block is already done"""
+
+        with self.lock:
+            if block_id not in self.leases:
+                return False
+            self.leases[block_id]["deadline"] = time.monotonic() + self.lease_time
+            return True
+
+    def complete_block(self, block_id, results):
+        """Write the results of a block to the output file, return False if it was already done"""
+
+        with self.lock:
+            if block_id not in self.leases:
+                return False
+            # Check that the results are (ip, label) pairs for the addresses of this block
+            ips = set(self.leases[block_id]["ips"])
+            for entry in results:
+                if not (isinstance(entry, list) and len(entry) == 2 and entry[0] in ips and isinstance(entry[1], str)):
+                    raise ValueError(f"Invalid result {entry!r} for block {block_id}")
+            # Each address of the block has exactly one result, otherwise the missing ones would never be written
+            if len(results) != len(ips) or set(entry[0] for entry in results) != ips:
+                raise ValueError(f"The results of block {block_id} do not cover each of its {len(ips)} addresses exactly once")
+            # The lease is only dropped once the results are written, so that the block is handed out again otherwise
+            scan.append_result(filename=self.output_file, data=results)
+            del self.leases[block_id]
+            if self.exhausted and not self.leases:
+                self.finished.set()
+            return True
+
+    def is_done(self):
+        """Check whether all the blocks are finished"""
+
+        return self.finished.is_set()
+
+
+class CoordinatorHandler(socketserver.StreamRequestHandler):
+    """Answer one request of a worker"""
+
+    def handle(self):
+        coordinator = self.server.coordinator
+        try:
+            request = json.loads(self.rfile.readline())
+            if request["type"] == "hello":
+                response = {"type": "config", "granularity": coordinator.granularity}
+            elif request["type"] == "get":
+                block = coordinator.get_block(worker=request["worker"])
+                if block:
+                    response = {"type": "block", "block_id": block[0], "granularity": coordinator.granularity, "ips": block[1]}
+                elif coordinator.is_done():
+                    response = {"type": "done"}
+                else:
+                    response = {"type": "wait"}
+            elif request["type"] == "renew":
+                response = {"type": "ok" if coordinator.renew_block(block_id=request["block_id"]) else "done"}
+            elif request["type"] == "results":
+                response = {"type": "ok" if coordinator.complete_block(block_id=request["block_id"], results=request["results"]) else "done"}
+            else:
+                raise ValueError(f"Unknown request type {request['type']}")
+        except (ValueError, KeyError, TypeError) as e:
+            logging.warning(f"Bad request from {self.client_address}: {e}")
+            response = {"type": "error", "error": str(e)}
+        except OSError as e:
+            # E.g. the results could not be written, the block stays leased
+            logging.warning(f"Could not process the request from {self.client_address}: {e}")
+            response = {"type": "error", "error": str(e)}
+        self.wfile.write(f"{json.dumps(response)}\n".encode())
+
+
+class CoordinatorServer(socketserver.ThreadingTCPServer):
+    """The TCP server of the coordinator, port 0 picks a free port"""
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, listen, coordinator):
+        # Listen on an IPv6 socket if the host is an IPv6 address
+        self.address_family = socket.getaddrinfo(listen[0], listen[1], type=socket.SOCK_STREAM)[0][0]
+        self.coordinator = coordinator
+        super().__init__(listen, CoordinatorHandler)
+
+
+def parse_address(address):
+    """Split a host:port string into a (host, port) tuple"""
+
+    host, port = address.rsplit(":", 1)
+    return host.strip("[]"), int(port)
+
+
+def run_coordinator(server, linger):
+    """Serve the workers until all the blocks are done"""
+
+    server_thread = threading.Thread(target=server.serve_forever, daemon=True)
+    server_thread.start()
+    server.coordinator.finished.wait()
+    # Keep answering for a while, so that the polling workers learn that the scan is over
+    time.sleep(linger)
+    server.shutdown()
+    server.server_close()
+
+
+def send_message(coordinator_address, message, timeout):
+    """Send one message to the coordinator and return its response"""
+
+    with socket.create_connection(coordinator_address, timeout=timeout) as sock:
+        sock.sendall(f"{json.dumps(message)}\n".encode())
+        with sock.makefile("rb") as f:
+            return json.loads(f.readline())
+
+
+def request_coordinator(coordinator_address, message, timeout, retries, poll_interval):
+    """Send a message to the coordinator, retry on failures, return None if it cannot be reached"""
+
+    for attempt in range(retries + 1):
+        try:
+            return send_message(coordinator_address=coordinator_address, message=message, timeout=timeout)
+        # The coordinator may not be started yet, be gone after the end of the scan,
+        # or close the connection without answering
+        except (OSError, ValueError) as e:
+            if attempt == retries:
+                logging.warning(f"Giving up on the coordinator {coordinator_address}: {e}")
+                return None
+            time.sleep(poll_interval)
+
+
+def renew_lease(coordinator_address, name, block_id, timeout):
+    """Extend the lease of a block, return False if another worker already finished it"""
+
+    try:
+        response = send_message(coordinator_address=coordinator_address, message={"type": "renew", "worker": name, "block_id": block_id}, timeout=timeout)
+    except (OSError, ValueError) as e:
+        # Keep working, the results are still accepted if nobody else finishes the block first
+        logging.warning(f"Could not renew the lease of block {block_id}: {e}")
+        return True
+
+    return response["type"] != "done"
+
+
+def run_worker(coordinator_address, threads, name, cache_file=None, cache_ttl=24, poll_interval=1, retries=5, timeout=30):
+    """Fingerprint the blocks handed out by the coordinator until the scan is over"""
+
+    # Build the decision tree before asking for work, so that it does not eat into the first lease
+    response = request_coordinator(coordinator_address=coordinator_address, message={"type": "hello", "worker": name}, timeout=timeout, retries=retries, poll_interval=poll_interval)
+    if response is None or response["type"] != "config":
+        return
+    granularity = response["granularity"]
+    decision_tree, vocabulary = scan.build_decision_tree(granularity=granularity)
+    testcase_names = scan.get_testcases(filename=f"{scan.get_work_dir()}/data/queries/queries_{granularity}.txt")
+
+    cache = result_cache.open_cache(filename=cache_file) if cache_file else None
+
+    # The cache is closed even if the worker fails, so that the results are not lost
+    try:
+        while True:
+            response = request_coordinator(coordinator_address=coordinator_address, message={"type": "get", "worker": name}, timeout=timeout, retries=retries, poll_interval=poll_interval)
+            if response is None or response["type"] == "done":
+                break
+            if response["type"] != "block":
+                time.sleep(poll_interval)
+                continue
+
+            # Process the block in chunks, as the standalone scanner does
+            block_id = response["block_id"]
+            results = list()
+            ips = iter(response["ips"])
+            block_done = False
+            while not block_done:
+                ips_to_scan = list(itertools.islice(ips, threads))
+                if not ips_to_scan:
+                    break
+                results += scan.scan_chunk(ips_to_scan=ips_to_scan, testcase_names=testcase_names, decision_tree=decision_tree, vocabulary=vocabulary, granularity=granularity, threads=threads, cache=cache, cache_ttl=cache_ttl * 3600)
+                # Renew the lease after each chunk, so that the block is only taken back from silent workers
+                block_done = not renew_lease(coordinator_address=coordinator_address, name=name, block_id=block_id, timeout=timeout)
+            # Another worker already sent the results of this block
+            if block_done:
+                continue
+
+            try:
+                response = send_message(coordinator_address=coordinator_address, message={"type": "results", "worker": name, "block_id": block_id, "results": results}, timeout=timeout)
+                if response["type"] == "error":
+                    logging.warning(f"The results of block {block_id} were rejected: {response['error']}")
+            except (OSError, ValueError) as e:
+                # The lease will expire and the block will be given to another worker
+                logging.warning(f"Could not send the results of block {block_id}: {e}")
+    finally:
+        if cache is not None:
+            result_cache.close_cache(cache=cache)
+
+
+if __name__ == '__main__':
+
+    # Parse command-line arguments
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="mode", required=True)
+    parser_coordinator = subparsers.add_parser("coordinator", help="Hand out the IP addresses to the workers and merge their results")
+    parser_coordinator.add_argument('-i', '--input_file', required=True, type=str, help="The input file with one IP address, CIDR block or range per line")
+    parser_coordinator.add_argument('-e', '--exclude_file', required=False, type=str, help="The file with IP addresses, CIDR blocks or ranges not to scan")
+    parser_coordinator.add_argument('-o', '--output_file', required=True, type=str, help="The output file with fingerprinting results")
+    parser_coordinator.add_argument('-g', '--granularity', required=True, choices=["vendor", "major", "minor", "build"], type=str, help="The fingerprinting granularity")
+    parser_coordinator.add_argument('-s', '--shuffle', action="store_true", help="Scan the addresses in a random order")
+    parser_coordinator.add_argument('--seed', required=False, type=int, help="The seed of the random order")
+    parser_coordinator.add_argument('-l', '--listen', required=False, default="127.0.0.1:7353", type=str, help="The host:port to listen on, defaults to 127.0.0.1:7353")
+    parser_coordinator.add_argument('-b', '--block_size', required=False, default=1000, type=int, help="The number of IP addresses per block, defaults to 1000")
+    parser_coordinator.add_argument('--lease_time', required=False, default=1800, type=float, help="The number of seconds a worker has to finish a block, defaults to 1800")
+    parser_worker = subparsers.add_parser("worker", help="Fingerprint the IP addresses handed out by the coordinator")
+    parser_worker.add_argument('-a', '--coordinator', required=True, type=str, help="The host:port of the coordinator")
+    parser_worker.add_argument('-t', '--threads', required=False, default=100, type=int, help="The number of threads, defaults to 100")
+    parser_worker.add_argument('-n', '--name', required=False, default=f"{socket.gethostname()}-{os.getpid()}", type=str, help="The worker name, defaults to <hostname>-<pid>")
+    parser_worker.add_argument('-c', '--cache_file', required=False, type=str, help="The on-disk cache of the previous results, fresh entries are only verified with the testcases of their decision path")
+    parser_worker.add_argument('--cache_ttl', required=False, default=24, type=float, help="The number of hours a cached result can be reused for, defaults to 24")
+    args = parser.parse_args()
+
+    # Get the working directory
+    work_dir = scan.get_work_dir()
+
+    # Configure logging
+    logging.basicConfig(filename=f"{work_dir}/dnssoftver.log", level=logging.WARNING, format='%(asctime)s %(name)s %(processName)s %(threadName)s %(levelname)s:%(message)s')
+
+    if args.mode == "coordinator":
+        # Read the input ranges, merged so that each address is scanned once
+        intervals = ip_ranges.read_intervals(filename=args.input_file)
+        if args.exclude_file:
+            intervals = ip_ranges.subtract_intervals(intervals=intervals, exclusions=ip_ranges.read_intervals(filename=args.exclude_file))
+        # The addresses are expanded lazily, one block at a time
+        addresses = ip_ranges.iter_addresses(intervals=intervals, shuffle=args.shuffle, seed=args.seed)
+        coordinator = Coordinator(addresses=addresses, granularity=args.granularity, output_file=args.output_file, block_size=args.block_size, lease_time=args.lease_time)
+        server = CoordinatorServer(listen=parse_address(args.listen), coordinator=coordinator)
+        run_coordinator(server=server, linger=5)
+    else:
+        run_worker(coordinator_address=parse_address(args.coordinator), threads=args.threads, name=args.name, cache_file=args.cache_file, cache_ttl=args.cache_ttl)
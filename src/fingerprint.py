@@ -166,11 +166,11 @@ def get_important_testcases():
         # Some signatures can correspond to multiple labels
         # However, in this case the decision tree will not work correctly
         # So, we need to merge those labels
-        input_data_merged_labels = build_models.merge_labels(data_raw=input_data)
-        # Load the processed input dataset to a DataFrame to be then passed to the classifier
-        input_data_df = build_models.data_to_df(data_merged=input_data_merged_labels)
+        input_data_merged_labels, input_data_weights = build_models.merge_labels(data_raw=input_data)
+        # Encode the processed input dataset as a sparse matrix to be then passed to the classifier
+        labels, features, vocabulary = build_models.data_to_matrix(data_merged=input_data_merged_labels)
         # Create the model
-        build_models.create_model(data=input_data_df, testcase_file=f"{work_dir}/data/queries/queries_{granularity}.txt", print_stats=True)
+        build_models.create_model(labels=labels, features=features, vocabulary=vocabulary, weights=input_data_weights, testcase_file=f"{work_dir}/data/queries/queries_{granularity}.txt", print_stats=True)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,259 @@
+# Copyright 2023 Yevheniya Nosyk
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# The input addresses are stored as sorted, merged and disjoint intervals of integers:
+#   {4: (starts, ends), 6: [(first, last), ...]}
+# IPv4 intervals are kept in two numpy uint32 arrays, so that millions of scattered addresses stay compact.
+# IPv6 inputs are usually few CIDR blocks, they are kept as a list of tuples of Python integers.
+
+import ipaddress
+import hashlib
+import logging
+import bisect
+import socket
+import random
+import array
+import numpy
+
+# Merge the pending IPv4 intervals into the compact arrays once there are this many of them
+MERGE_THRESHOLD = 1000000
+
+IPV4_MAX = 2 ** 32 - 1
+
+# The number of rounds of the Feistel network that shuffles the addresses
+FEISTEL_ROUNDS = 4
+
+
+def parse_line(line):
+    """Parse an IP address, CIDR block or range into a (version, first, last) interval"""
+
+    # Drop comments and leading and trailing whitespaces
+    line = line.split("#")[0].strip()
+    if not line:
+        return None
+
+    # A range is written as "<first_ip>-<last_ip>"
+    if "-" in line:
+        first, last = (ipaddress.ip_address(i.strip()) for i in line.split("-", 1))
+        if first.version != last.version:
+            raise ValueError(f"{line!r} mixes IPv4 and IPv6 addresses")
+        if first > last:
+            raise ValueError(f"{line!r} ends before it starts")
+        return (first.version, int(first), int(last))
+
+    # A single IP address is parsed as a /32 or /128 network
+    network = ipaddress.ip_network(line, strict=False)
+    return (network.version, int(network.network_address), int(network.broadcast_address))
+
+
+def merge_ipv4(starts, ends):
+    """Sort the IPv4 intervals and merge the overlapping and adjacent ones"""
+
+    if not len(starts):
+        return numpy.empty(0, dtype=numpy.uint32), numpy.empty(0, dtype=numpy.uint32)
+
+    # Work with 64-bit integers, so that adding 1 to the last IPv4 address does not overflow
+    order = numpy.argsort(starts, kind="stable")
+    starts = numpy.asarray(starts, dtype=numpy.int64)[order]
+    ends = numpy.asarray(ends, dtype=numpy.int64)[order]
+    # A new interval begins where the start is after all the previous ends
+    ends_max = numpy.maximum.accumulate(ends)
+    is_first = numpy.ones(len(starts), dtype=bool)
+    is_first[1:] = starts[1:] > ends_max[:-1] + 1
+    firsts = numpy.flatnonzero(is_first)
+
+    return starts[firsts].astype(numpy.uint32), numpy.maximum.reduceat(ends, firsts).astype(numpy.uint32)
+
+
+def subtract_ipv4(starts, ends, exclusion_starts, exclusion_ends):
+    """Remove the excluded IPv4 intervals, both sets being sorted and merged"""
+
+    # Build the complement of the exclusions, i.e. the gaps between them
+    exclusion_starts = exclusion_starts.astype(numpy.int64)
+    exclusion_ends = exclusion_ends.astype(numpy.int64)
+    gap_starts = numpy.concatenate(([0], exclusion_ends + 1))
+    gap_ends = numpy.concatenate((exclusion_starts - 1, [IPV4_MAX]))
+    valid = gap_starts <= gap_ends
+    gap_starts, gap_ends = gap_starts[valid], gap_ends[valid]
+
+    # Intersect the targets with the gaps: each target overlaps the gaps from first to last - 1
+    starts = starts.astype(numpy.int64)
+    ends = ends.astype(numpy.int64)
+    first = numpy.searchsorted(gap_ends, starts, side="left")
+    last = numpy.searchsorted(gap_starts, ends, side="right")
+    counts = numpy.maximum(last - first, 0)
+    targets = numpy.repeat(numpy.arange(len(starts)), counts)
+    gaps = numpy.arange(counts.sum()) - numpy.repeat(numpy.cumsum(counts) - counts, counts) + numpy.repeat(first, counts)
+
+    return numpy.maximum(starts[targets], gap_starts[gaps]).astype(numpy.uint32), numpy.minimum(ends[targets], gap_ends[gaps]).astype(numpy.uint32)
+
+
+def merge_intervals(intervals):
+    """Sort the (first, last) intervals and merge the overlapping and adjacent ones"""
+
+    merged = list()
+    for first, last in sorted(intervals):
+        if merged and first <= merged[-1][1] + 1:
+            if last > merged[-1][1]:
+                merged[-1] = (merged[-1][0], last)
+        else:
+            merged.append((first, last))
+
+    return merged
+
+
+def subtract_intervals_list(intervals, exclusions):
+    """Remove the excluded (first, last) intervals, both lists being sorted and merged"""
+
+    result = list()
+    j = 0
+    for first, last in intervals:
+        # Skip the exclusions that end before the current interval
+        while j < len(exclusions) and exclusions[j][1] < first:
+            j += 1
+        # Cut the current interval with all the exclusions that overlap it
+        k = j
+        while k < len(exclusions) and exclusions[k][0] <= last:
+            if exclusions[k][0] > first:
+                result.append((first, exclusions[k][0] - 1))
+            first = max(first, exclusions[k][1] + 1)
+            k += 1
+        if first <= last:
+            result.append((first, last))
+
+    return result
+
+
+def subtract_intervals(intervals, exclusions):
+    """Remove the excluded addresses from the target ones"""
+
+    ipv4 = subtract_ipv4(*intervals[4], *exclusions[4])
+    ipv6 = subtract_intervals_list(intervals=intervals[6], exclusions=exclusions[6])
+
+    return {4: ipv4, 6: ipv6}
+
+
+def read_intervals(filename):
+    """Read the input file and return the merged intervals"""
+
+    ipv4_merged = merge_ipv4(starts=[], ends=[])
+    ipv4_starts = array.array("I")
+    ipv4_ends = array.array("I")
+    ipv6 = list()
+
+    with open(filename, "r") as f:
+        for line in f:
+            if "#" in line:
+                line = line.split("#")[0]
+            line = line.strip()
+            # Fast path for the lines with a single IPv4 address, the most common input
+            try:
+                value = int.from_bytes(socket.inet_pton(socket.AF_INET, line), "big")
+                ipv4_starts.append(value)
+                ipv4_ends.append(value)
+            except OSError:
+                try:
+                    interval = parse_line(line)
+                except ValueError as e:
+                    logging.warning(e)
+                    continue
+                if interval is None:
+                    continue
+                if interval[0] == 4:
+                    ipv4_starts.append(interval[1])
+                    ipv4_ends.append(interval[2])
+                else:
+                    ipv6.append(interval[1:])
+            # Keep the memory usage bounded when the input is a long list of single addresses
+            if len(ipv4_starts) >= MERGE_THRESHOLD:
+                ipv4_merged = merge_ipv4(starts=numpy.concatenate((ipv4_merged[0], ipv4_starts)), ends=numpy.concatenate((ipv4_merged[1], ipv4_ends)))
+                ipv4_starts = array.array("I")
+                ipv4_ends = array.array("I")
+
+    ipv4_merged = merge_ipv4(starts=numpy.concatenate((ipv4_merged[0], ipv4_starts)), ends=numpy.concatenate((ipv4_merged[1], ipv4_ends)))
+
+    return {4: ipv4_merged, 6: merge_intervals(intervals=ipv6)}
+
+
+def count_addresses(intervals):
+    """Return the number of addresses covered by the intervals"""
+
+    starts, ends = intervals[4]
+    ipv4_count = int((ends.astype(numpy.int64) - starts.astype(numpy.int64) + 1).sum())
+
+    return ipv4_count + sum(last - first + 1 for first, last in intervals[6])
+
+
+def to_address(version, value):
+    """Convert an integer back to the IP address string"""
+
+    if version == 4:
+        return socket.inet_ntop(socket.AF_INET, value.to_bytes(4, "big"))
+    return str(ipaddress.IPv6Address(value))
+
+
+def feistel(value, half_bits, keys):
+    """Encrypt a 2 * half_bits integer with a Feistel network, which is a bijection"""
+
+    mask = (1 << half_bits) - 1
+    size = max(1, (half_bits + 7) // 8)
+    left, right = value >> half_bits, value & mask
+    for key in keys:
+        digest = hashlib.blake2b(right.to_bytes(size, "big"), key=key, digest_size=16).digest()
+        left, right = right, left ^ (int.from_bytes(digest, "big") & mask)
+
+    return (left << half_bits) | right
+
+
+def iter_addresses(intervals, shuffle=False, seed=None):
+    """Lazily yield every address from the intervals, optionally in a random order"""
+
+    ipv4_starts, ipv4_ends = intervals[4]
+
+    if not shuffle:
+        for first, last in zip(ipv4_starts.tolist(), ipv4_ends.tolist()):
+            for value in range(first, last + 1):
+                yield to_address(4, value)
+        for first, last in intervals[6]:
+            for value in range(first, last + 1):
+                yield to_address(6, value)
+        return
+
+    # Number the addresses from 0 to total - 1, the IPv4 ones first
+    ipv4_offsets = numpy.concatenate(([0], numpy.cumsum(ipv4_ends.astype(numpy.int64) - ipv4_starts.astype(numpy.int64) + 1)))
+    ipv4_total = int(ipv4_offsets[-1])
+    ipv6_offsets = [ipv4_total]
+    for first, last in intervals[6]:
+        ipv6_offsets.append(ipv6_offsets[-1] + last - first + 1)
+    total = ipv6_offsets[-1]
+    if not total:
+        return
+
+    # A Feistel network with random keys permutes the smallest even power of two above the total.
+    # Going through its inputs in order and keeping the outputs below the total yields each address once,
+    # in an order where consecutive addresses are unrelated, without storing the order in memory
+    rng = random.Random(seed)
+    keys = [rng.randbytes(16) for _ in range(FEISTEL_ROUNDS)]
+    half_bits = ((total - 1).bit_length() + 1) // 2
+
+    for i in range(1 << (2 * half_bits)):
+        index = feistel(value=i, half_bits=half_bits, keys=keys)
+        if index >= total:
+            continue
+        if index < ipv4_total:
+            k = int(numpy.searchsorted(ipv4_offsets, index, side="right")) - 1
+            yield to_address(4, int(ipv4_starts[k]) + index - int(ipv4_offsets[k]))
+        else:
+            k = bisect.bisect_right(ipv6_offsets, index) - 1
+            yield to_address(6, intervals[6][k][0] + index - ipv6_offsets[k])
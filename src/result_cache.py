@@ -0,0 +1,50 @@
+# Copyright 2023 Yevheniya Nosyk
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sqlite3
+import json
+
+
+def open_cache(filename):
+    """Open the on-disk SQLite database with the previous results, create it if needed"""
+
+    cache = sqlite3.connect(filename)
+    # Labels depend on the granularity, so the same IP is cached once per granularity
+    cache.execute("CREATE TABLE IF NOT EXISTS results (granularity TEXT NOT NULL, ip TEXT NOT NULL, signatures TEXT NOT NULL, label TEXT NOT NULL, timestamp REAL NOT NULL, PRIMARY KEY (granularity, ip))")
+    cache.commit()
+
+    return cache
+
+
+def close_cache(cache):
+    """Save the pending results and close the database"""
+
+    cache.commit()
+    cache.close()
+
+
+def get_entry(cache, granularity, ip, ttl, now):
+    """Return the cached entry of an IP address if it is younger than the TTL"""
+
+    row = cache.execute("SELECT signatures, label, timestamp FROM results WHERE granularity = ? AND ip = ? AND timestamp > ?", (granularity, ip, now - ttl)).fetchone()
+    if row is None:
+        return None
+
+    return {"signatures": json.loads(row[0]), "label": row[1], "timestamp": row[2]}
+
+
+def put_entry(cache, granularity, ip, signatures, label, now):
+    """Store the signatures and the label of an IP address, call cache.commit() to save them"""
+
+    cache.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)", (granularity, ip, json.dumps(signatures), label, now))
@@ -12,23 +12,20 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import multiprocessing.pool
 import multiprocessing
 import build_models
+import result_cache
 import collections
+import ip_ranges
 import testcases
-import ipaddress
 import itertools
 import argparse
-import warnings
 import logging
 import json
+import time
 import os
 
-# Ignore the Pandas DeprecationWarning
-with warnings.catch_warnings():
-    warnings.simplefilter(action="ignore", category=DeprecationWarning)
-    import pandas
-
 def get_work_dir():
     """Find the path to the project's work directory"""
 
@@ -71,7 +68,7 @@ def execute_queries(ip_to_fingerprint, queries_important):
     
     return results_per_ip
 
-def get_model_data(data_input,model):
+def get_model_data(data_input,vocabulary):
     """Prepare the data for the decision tree"""
 
     # Process the data so that signatures become tuples
@@ -89,33 +86,102 @@ def get_model_data(data_input,model):
             entry_processed[ip][testcase] = testresult_sorted
         data_processed.append(dict(entry_processed))
 
-    # Get all the column names from one of the entries
-    column_names_features = [j for i in data_processed[0].values() for j in i]
-    column_names_all = ["ip"] + column_names_features
-    # Make the processed data flat
-    data_processed_flat = list()
-    for entry in data_processed:
-        for ip in entry:
-            entry_flat = list()
-            for column in column_names_all:
-                if column == "ip":
-                    entry_flat.append(ip)
-                else:
-                    entry_flat.append(entry[ip][column])
-            data_processed_flat.append(entry_flat)
-
-    # Create a DataFrame
-    df = pandas.DataFrame(data_processed_flat, columns=column_names_all)       
-    # Do the one hot encoding
-    df_one_hot = pandas.get_dummies(data=df, columns=column_names_features)
-
-    # We need to ensure that the dataset includes all the features used at the training stage, 
-    # even if the feature is equal to 0
-    for feature in model.feature_names_in_:
-        if feature not in df_one_hot.columns:
-            df_one_hot[feature] = False
-
-    return df_one_hot
+    # Do the one hot encoding with the same columns as used at the training stage,
+    # signatures that were not seen during the training do not set any column
+    ips, features, _ = build_models.data_to_matrix(data_merged=data_processed, vocabulary=vocabulary)
+
+    return ips, features
+
+
+def probe(targets, threads):
+    """Issue the testcases to the IPs in parallel and group the signatures by IP address"""
+
+    # E.g. no cached IP has a testcase on its decision path when the tree is a single leaf
+    if not targets:
+        return collections.defaultdict(dict)
+
+    # The number of threads is the minimum of the number of targets and the value passed to the program
+    with multiprocessing.pool.ThreadPool(min(threads,len(targets))) as p:
+        results = p.starmap(execute_queries, targets)
+
+    # Group the results obtained above by IP addresses
+    results_grouped = collections.defaultdict(dict)
+    for ip_tested in results:
+        for testcase in ip_tested:
+            results_grouped[testcase["ip"]][testcase["query_name"]] = testcase["signature"]
+
+    return results_grouped
+
+
+def classify(data_input, decision_tree, vocabulary):
+    """Predict the software of each IP address and return the (ip, label) tuples"""
+
+    # Prepare the query results to be consumed by a model
+    ips, features = get_model_data(data_input=data_input,vocabulary=vocabulary)
+    # Classify
+    predicted = decision_tree.predict(features)
+
+    return list(zip(ips,predicted.tolist()))
+
+
+def verify_cached(ips_to_scan, cache, granularity, ttl, threads, decision_tree, vocabulary):
+    """Reuse the cached results of the IPs that still answer as before, return their labels and the IPs to scan"""
+
+    now = time.time()
+    entries = dict()
+    for ip in ips_to_scan:
+        entry = result_cache.get_entry(cache=cache, granularity=granularity, ip=ip, ttl=ttl, now=now)
+        if entry:
+            entries[ip] = entry
+    if not entries:
+        return list(), ips_to_scan
+
+    # The label only depends on the testcases checked along the decision path of the cached signatures.
+    # If they all answer as before, the tree reaches the same leaf, so only these testcases are verified
+    ips_cached, features = get_model_data(data_input={ip: entries[ip]["signatures"] for ip in entries}, vocabulary=vocabulary)
+    labels = decision_tree.predict(features).tolist()
+    paths = decision_tree.decision_path(features)
+    columns = list(vocabulary)
+    targets = list()
+    for row, ip in enumerate(ips_cached):
+        nodes = paths.indices[paths.indptr[row]:paths.indptr[row + 1]]
+        # Leaves have a negative feature index
+        testcases_path = sorted(set(columns[decision_tree.tree_.feature[node]][0] for node in nodes if decision_tree.tree_.feature[node] >= 0))
+        targets.append((ip,testcases_path))
+    results = probe(targets=[target for target in targets if target[1]], threads=threads)
+
+    # The cached result is valid if none of the verified signatures changed
+    confirmed = list()
+    ips_changed = list(ip for ip in ips_to_scan if ip not in entries)
+    for (ip, testcases_path), label in zip(targets, labels):
+        if all(results.get(ip, {}).get(testcase) == entries[ip]["signatures"].get(testcase) for testcase in testcases_path):
+            confirmed.append((ip,label))
+        else:
+            ips_changed.append(ip)
+
+    return confirmed, ips_changed
+
+
+def scan_chunk(ips_to_scan, testcase_names, decision_tree, vocabulary, granularity, threads, cache=None, cache_ttl=None):
+    """Fingerprint a chunk of IPs and return the (ip, label) tuples"""
+
+    chunk_predicted = list()
+    # Only verify the hosts with fresh cached results, they do not need all the testcases
+    if cache is not None:
+        chunk_predicted, ips_to_scan = verify_cached(ips_to_scan=ips_to_scan, cache=cache, granularity=granularity, ttl=cache_ttl, threads=threads, decision_tree=decision_tree, vocabulary=vocabulary)
+    if ips_to_scan:
+        # Execute important testcase only
+        results_chunk = probe(targets=[(i,testcase_names) for i in ips_to_scan], threads=threads)
+        chunk_classified = classify(data_input=results_chunk, decision_tree=decision_tree, vocabulary=vocabulary)
+        # Remember the new results for the next scans
+        if cache is not None:
+            now = time.time()
+            for ip, label in chunk_classified:
+                result_cache.put_entry(cache=cache, granularity=granularity, ip=ip, signatures=results_chunk[ip], label=label, now=now)
+            cache.commit()
+        chunk_predicted += chunk_classified
+
+    return chunk_predicted
 
 
 def append_result(filename,data):
@@ -127,34 +193,37 @@ def append_result(filename,data):
             f.write(f"{json.dumps(result)}\n")
 
 def build_decision_tree(granularity):
-    """Build the decision tree for the desired granularity"""
+    """Build the decision tree for the desired granularity and return it with its vocabulary"""
 
+    work_dir = get_work_dir()
     input_data = build_models.read_input_file(filename=f"{work_dir}/data/signatures/signatures_{granularity }.json.bz2", granularity=granularity)
     # Some signatures can correspond to multiple labels
     # However, in this case the decision tree will not work correctly
     # So, we need to merge those labels
-    input_data_merged_labels = build_models.merge_labels(data_raw=input_data)
-    # Load the processed input dataset to a DataFrame to be then passed to the classifier
-    input_data_df = build_models.data_to_df(data_merged=input_data_merged_labels)
+    input_data_merged_labels, input_data_weights = build_models.merge_labels(data_raw=input_data)
+    # Encode the processed input dataset as a sparse matrix to be then passed to the classifier
+    labels, features, vocabulary = build_models.data_to_matrix(data_merged=input_data_merged_labels)
     # Create the model
-    tree = build_models.create_model(data=input_data_df, testcase_file=None, print_stats=False)
+    tree = build_models.create_model(labels=labels, features=features, vocabulary=vocabulary, weights=input_data_weights, testcase_file=None, print_stats=False)
 
-    return tree
+    return tree, vocabulary
 
 
 if __name__ == '__main__':
 
     # Parse command-line arguments
     parser = argparse.ArgumentParser()
-    parser.add_argument('-i', '--input_file', required=True, type=str, help="The input file with one IP address per line")
+    parser.add_argument('-i', '--input_file', required=True, type=str, help="The input file with one IP address, CIDR block or range per line")
+    parser.add_argument('-e', '--exclude_file', required=False, type=str, help="The file with IP addresses, CIDR blocks or ranges not to scan")
     parser.add_argument('-o', '--output_file', required=True, type=str, help="The output file with fingerprinting results")
     parser.add_argument('-t', '--threads', required=False, default=100, type=int, help="The number of threads, defaults to 100")
     parser.add_argument('-g', '--granularity', required=True, choices=["vendor", "major", "minor", "build"], type=str, help="The fingerprinting granularity")
+    parser.add_argument('-s', '--shuffle', action="store_true", help="Scan the addresses in a random order")
+    parser.add_argument('--seed', required=False, type=int, help="The seed of the random order")
+    parser.add_argument('-c', '--cache_file', required=False, type=str, help="The on-disk cache of the previous results, fresh entries are only verified with the testcases of their decision path")
+    parser.add_argument('--cache_ttl', required=False, default=24, type=float, help="The number of hours a cached result can be reused for, defaults to 24")
     args = parser.parse_args()
 
-    # Ignore some of the Pandas warnings
-    warnings.simplefilter(action="ignore", category=pandas.errors.PerformanceWarning)
-
     # Get the working directory
     work_dir = get_work_dir()
 
@@ -162,51 +231,32 @@ if __name__ == '__main__':
     logging.basicConfig(filename=f"{work_dir}/dnssoftver.log", level=logging.WARNING, format='%(asctime)s %(name)s %(processName)s %(threadName)s %(levelname)s:%(message)s')
 
     # Build the decision tree
-    decision_tree = build_decision_tree(granularity=args.granularity)
+    decision_tree, vocabulary = build_decision_tree(granularity=args.granularity)
 
     # Get the names of the testcases that were used to build the tree
     testcase_names = get_testcases(filename=f"{work_dir}/data/queries/queries_{args.granularity}.txt")
 
-    # We process the input file in chunks
-    with open(args.input_file, "r") as f:
+    # Read the input ranges, merged so that each address is scanned once
+    intervals = ip_ranges.read_intervals(filename=args.input_file)
+    if args.exclude_file:
+        intervals = ip_ranges.subtract_intervals(intervals=intervals, exclusions=ip_ranges.read_intervals(filename=args.exclude_file))
+    # The addresses are expanded lazily, one chunk at a time
+    addresses = ip_ranges.iter_addresses(intervals=intervals, shuffle=args.shuffle, seed=args.seed)
+
+    # Open the cache of the previous results
+    cache = result_cache.open_cache(filename=args.cache_file) if args.cache_file else None
+
+    # We process the input addresses in chunks
+    # The cache is closed even if the scan is interrupted, so that the results are not lost
+    try:
         while True:
-            chunk = list(itertools.islice(f, int(args.threads)))
-            if chunk:
-                # Ensure that all the entries in the current chunk are valid IP addresses
-                ips_to_scan = list()
-                for ip in chunk:
-                    # Remove leading and trailing whitespaces from each input line
-                    ip = ip.strip()
-                    # Check that the string is a valid IPv4 or IPv6 address
-                    try:
-                        ipaddress.ip_address(ip)
-                        ips_to_scan.append(ip)
-                    except ValueError as e:
-                        logging.warning(e)
-                        continue
-                # Process the chunk of IPs if not empty
-                if ips_to_scan:
-                    # The number of threads is the minimum of the chunk size and the value passed to the program
-                    threads = min(args.threads,len(ips_to_scan))
-                    # Prepare the tuples of IPs to scan and testcases to issue
-                    targets = [(i,testcase_names) for i in ips_to_scan]
-                    # Execute important testcase only
-                    with multiprocessing.pool.ThreadPool(threads) as p:
-                        results= p.starmap(execute_queries, targets)
-                    # Group the results obtained above by IP addresses
-                    results_chunk = collections.defaultdict(dict)
-                    for ip_tested in results:
-                        for testcase in ip_tested:
-                            results_chunk[testcase["ip"]][testcase["query_name"]] = testcase["signature"]
-                    # Prepare the query results to be consumed by a model
-                    df_results_chunk = get_model_data(data_input=results_chunk,model=decision_tree)
-                    # Classify
-                    df_results_chunk_test =  df_results_chunk.loc[:, df_results_chunk.columns != 'ip']
-                    # Columns in train and test datasets must be in the same order
-                    df_results_chunk_test = df_results_chunk_test[decision_tree.feature_names_in_]
-                    df_results_chunk_pred =  decision_tree.predict(df_results_chunk_test)
-                    # Save the chunk result as tuples and write to the output file
-                    chunk_predicted = zip(df_results_chunk["ip"].tolist(),df_results_chunk_pred.tolist())
-                    append_result(filename=args.output_file, data=chunk_predicted)
+            ips_to_scan = list(itertools.islice(addresses, int(args.threads)))
+            if ips_to_scan:
+                chunk_predicted = scan_chunk(ips_to_scan=ips_to_scan, testcase_names=testcase_names, decision_tree=decision_tree, vocabulary=vocabulary, granularity=args.granularity, threads=args.threads, cache=cache, cache_ttl=args.cache_ttl * 3600)
+                # Write the chunk result to the output file
+                append_result(filename=args.output_file, data=chunk_predicted)
             else:
                 break
+    finally:
+        if cache is not None:
+            result_cache.close_cache(cache=cache)
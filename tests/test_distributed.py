@@ -0,0 +1,141 @@
+# Copyright 2023 Yevheniya Nosyk
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Run a distributed scan over localhost: one coordinator, several workers and one dead worker.
+# The DNS queries are answered locally, so the test runs offline.
+# Run it with pytest or directly: python3 tests/test_distributed.py
+
+import unittest.mock
+import functools
+import threading
+import tempfile
+import json
+import time
+import sys
+import os
+
+# The tested modules live in src/
+sys.path.insert(0, os.path.join(os.path.split(os.path.split(os.path.abspath(__file__))[0])[0], "src"))
+
+import distributed
+import ip_ranges
+import dns.message
+import dns.query
+import dns.flags
+import scan
+
+WORKERS = 3
+GRANULARITY = "vendor"
+
+
+def fake_udp(q, where, timeout=None, **kwargs):
+    """Answer a query locally instead of sending it over the network"""
+
+    response = dns.message.make_response(q)
+    response.flags |= dns.flags.RA
+    return response
+
+
+def test_localhost_scan():
+    """Every address is scanned and written exactly once, even the ones leased to a dead worker"""
+
+    # The workers share one decision tree, built once before the scan
+    build_decision_tree = functools.lru_cache(maxsize=None)(scan.build_decision_tree)
+    build_decision_tree(granularity=GRANULARITY)
+
+    with tempfile.TemporaryDirectory() as work_dir, unittest.mock.patch.object(dns.query, "udp", fake_udp), unittest.mock.patch.object(scan, "build_decision_tree", build_decision_tree):
+        input_file = os.path.join(work_dir, "input.txt")
+        output_file = os.path.join(work_dir, "output.json")
+        with open(input_file, "w") as f:
+            f.write("192.0.2.0/24\n198.51.100.10-198.51.100.40\n")
+        intervals = ip_ranges.read_intervals(filename=input_file)
+        expected = set(ip_ranges.iter_addresses(intervals=intervals))
+
+        addresses = ip_ranges.iter_addresses(intervals=intervals, shuffle=True, seed=1)
+        coordinator = distributed.Coordinator(addresses=addresses, granularity=GRANULARITY, output_file=output_file, block_size=32, lease_time=2)
+        server = distributed.CoordinatorServer(listen=("127.0.0.1", 0), coordinator=coordinator)
+        coordinator_thread = threading.Thread(target=distributed.run_coordinator, kwargs={"server": server, "linger": 1})
+        coordinator_thread.start()
+
+        # A dead worker takes a block and never sends its results
+        response = distributed.send_message(coordinator_address=server.server_address, message={"type": "get", "worker": "dead"}, timeout=5)
+        assert response["type"] == "block"
+
+        workers = [threading.Thread(target=distributed.run_worker, kwargs={"coordinator_address": server.server_address, "threads": 8, "name": f"worker-{i}", "poll_interval": 0.2}) for i in range(WORKERS)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join(timeout=120)
+        coordinator_thread.join(timeout=120)
+        assert coordinator.is_done()
+
+        with open(output_file, "r") as f:
+            results = [json.loads(line) for line in f]
+
+    ips = [result["ip"] for result in results]
+    assert len(ips) == len(set(ips))
+    assert set(ips) == expected
+
+
+def test_incomplete_results():
+    """Results that miss or repeat addresses of a block are rejected and the block stays leased"""
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        output_file = os.path.join(work_dir, "output.json")
+        coordinator = distributed.Coordinator(addresses=iter(["192.0.2.1", "192.0.2.2"]), granularity=GRANULARITY, output_file=output_file, block_size=2, lease_time=60)
+        block_id, ips = coordinator.get_block(worker="worker")
+        assert coordinator.get_block(worker="worker") is None
+
+        for results in ([], [[ips[0], "bind9"]], [[ips[0], "bind9"], [ips[0], "bind9"]]):
+            try:
+                coordinator.complete_block(block_id=block_id, results=results)
+            except ValueError:
+                pass
+            else:
+                raise AssertionError(f"{results!r} was accepted")
+            assert block_id in coordinator.leases
+            assert not os.path.exists(output_file)
+
+        coordinator.complete_block(block_id=block_id, results=[[ip, "bind9"] for ip in ips])
+        assert coordinator.is_done()
+        with open(output_file, "r") as f:
+            assert set(json.loads(line)["ip"] for line in f) == set(ips)
+
+
+def test_renew_lease():
+    """A renewed block is not handed out again, and renewing a finished block tells the worker to drop it"""
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        output_file = os.path.join(work_dir, "output.json")
+        coordinator = distributed.Coordinator(addresses=iter(["192.0.2.1", "192.0.2.2"]), granularity=GRANULARITY, output_file=output_file, block_size=1, lease_time=0.5)
+        block_id, ips = coordinator.get_block(worker="slow")
+
+        # The slow worker keeps renewing past the original deadline, so the other worker gets a new block
+        for _ in range(3):
+            time.sleep(0.25)
+            assert coordinator.renew_block(block_id=block_id)
+        other_block_id, _ = coordinator.get_block(worker="other")
+        assert other_block_id != block_id
+
+        # Once the block is done, its renewals and late results are answered with False
+        assert coordinator.complete_block(block_id=block_id, results=[[ip, "bind9"] for ip in ips])
+        assert not coordinator.renew_block(block_id=block_id)
+        assert not coordinator.complete_block(block_id=block_id, results=[[ip, "bind9"] for ip in ips])
+
+
+if __name__ == '__main__':
+    test_localhost_scan()
+    test_incomplete_results()
+    test_renew_lease()
+    print("OK")